@@ -1,14 +1,29 @@
 import uuid
 import os
+import asyncio
+import copy
+import inspect
+import mmap
+import functools
 import boto3
 import json
+import random
+import re
+import string
 import time
 from botocore.exceptions import ClientError
 import logging
-from typing import Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import zip_longest
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 from pathlib import Path
-from sec_api import QueryApi, RenderApi
 from ragas.dataset_schema import (
     MultiTurnSample,
     SingleTurnSample
@@ -16,6 +31,18 @@ from ragas.dataset_schema import (
 
 from ragas import evaluate
 
+# Optional: orjson parses test case files faster than the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: pyahocorasick speeds up matching traces against many test cases
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -31,8 +58,52 @@ boto3_session = boto3.session.Session()
 region_name = boto3_session.region_name
 account_id = sts_client.get_caller_identity()['Account']
 
+# S3 client config sized for the upload thread pools; adaptive retries handle throttling
+BOTO_CFG = Config(
+    max_pool_connections=64,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True
+)
+
+# Shared S3 client for the download/upload thread pool (boto3 clients are thread-safe)
+s3_client = boto3_session.client('s3', config=BOTO_CFG)
+
 SEC_API_KEY='unset'
 
+# Number of companies processed and preloaded files uploaded concurrently,
+# and cap on in-flight SEC API requests (including filings being streamed)
+MAX_COMPANY_WORKERS = 16
+MAX_UPLOAD_WORKERS = 32
+SEC_API_MAX_CONCURRENCY = 8
+sec_api_semaphore = threading.BoundedSemaphore(SEC_API_MAX_CONCURRENCY)
+
+# Query string template for 10-K filings of one or more tickers
+TEN_K_QUERY = 'formType:"10-K" AND ticker:{tickers}'
+
+# Symbols per bulk filings query and results per page (SEC API returns at most 50)
+SEC_QUERY_CHUNK_SIZE = 50
+SEC_QUERY_PAGE_SIZE = 50
+
+
+# Shared HTTP session for all sec-api traffic (filing queries and the filing mirror),
+# so every thread reuses the same keep-alive connections; 429 responses are
+# retried with backoff like sec-api's own clients do
+SEC_QUERY_API_URL = "https://api.sec-api.io"
+SEC_FILING_MIRROR_URL = "https://edgar-mirror.sec-api.io"
+sec_http_session = requests.Session()
+sec_http_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429],
+        allowed_methods=frozenset({'GET', 'POST'})
+    )
+))
+
+# Stream uploads part by part in the calling thread to keep memory per filing bounded
+STREAM_TRANSFER_CONFIG = TransferConfig(use_threads=False)
 
 # Headers for direct SEC requests
 headers = {
@@ -46,6 +117,11 @@ sec_base_url = "https://www.sec.gov"
 edgar_search_url = "https://www.sec.gov/cgi-bin/browse-edgar"
 
 ### FUNCTIONS TO CREATE S3 VECTOR KNOWLEDGE BASE ### 
+@functools.lru_cache(maxsize=16)
+def _s3_client_for(region):
+    """Return a cached S3 client for the given region"""
+    return boto3_session.client('s3', region_name=region or 'us-east-1', config=BOTO_CFG)
+
 def create_s3_bucket(bucket_name, region=None):
     """
     Create an S3 bucket
@@ -58,7 +134,7 @@ def create_s3_bucket(bucket_name, region=None):
         bool: True if bucket was created, False otherwise
     """
     try:
-        s3_client = boto3.client('s3', region_name=region if region else 'us-east-1')
+        s3_client = _s3_client_for(region)
         
         # For us-east-1, no LocationConstraint should be provided
         if region is None or region == 'us-east-1':
@@ -88,25 +164,109 @@ def generate_short_code():
     
     return short_code
 
-def empty_and_delete_bucket(bucket_name):
+def empty_and_delete_bucket(bucket_name, client=None):
     """
     Empty and delete an S3 bucket, including all objects and versions
+
+    Args:
+        bucket_name: Name of the bucket to delete
+        client: S3 client to use; defaults to the shared module client
     """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    
-    # Delete all objects
-    bucket.objects.all().delete()
-    
-    # Delete all object versions if versioning is enabled
-    bucket_versioning = boto3.client('s3').get_bucket_versioning(Bucket=bucket_name)
-    if 'Status' in bucket_versioning and bucket_versioning['Status'] == 'Enabled':
-        bucket.object_versions.all().delete()
-    
+    s3 = client or s3_client
+
+    # Delete all objects, up to 1000 keys per delete_objects call
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name):
+        batch = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if batch:
+            s3.delete_objects(Bucket=bucket_name, Delete={'Objects': batch, 'Quiet': True})
+
+    # Delete any remaining object versions and delete markers; for buckets that
+    # never had versioning the first page is empty and we stop there
+    paginator = s3.get_paginator('list_object_versions')
+    for page in paginator.paginate(Bucket=bucket_name):
+        batch = [
+            {'Key': version['Key'], 'VersionId': version['VersionId']}
+            for version in page.get('Versions', []) + page.get('DeleteMarkers', [])
+        ]
+        if not batch:
+            break
+        # A page can hold up to 1000 versions plus 1000 delete markers
+        for start in range(0, len(batch), 1000):
+            s3.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': batch[start:start + 1000], 'Quiet': True}
+            )
+
     # Now delete the empty bucket
-    boto3.client('s3').delete_bucket(Bucket=bucket_name)
+    s3.delete_bucket(Bucket=bucket_name)
     logger.info(f"Bucket {bucket_name} has been emptied and deleted.")
 
+# Knowledge base execution role policies, serialized once; per-role values are
+# filled in with string.Template placeholders
+_KB_POLICY_TEMPLATE = string.Template(json.dumps({
+    "Version": "2012-10-17",
+    "Statement": [
+        # foundation model access
+        {
+            "Effect": "Allow",
+            "Action": [
+                "bedrock:InvokeModel",
+            ],
+            "Resource": [
+                "arn:aws:bedrock:${region}::foundation-model/amazon.titan-embed-text-v2:0",
+                "arn:aws:bedrock:${region}::foundation-model/anthropic.claude-3-sonnet-20240229-v1:0",
+                "arn:aws:bedrock:${region}::foundation-model/cohere.rerank-v3-5:0"
+            ]
+        },
+        # writing logs to CloudWatch Logs
+        {
+            "Effect": "Allow",
+            "Action": [
+                "logs:CreateLogStream",
+                "logs:PutLogEvents",
+                "logs:DescribeLogStreams"
+            ],
+            "Resource": "arn:aws:logs:*:*:log-group:/aws/bedrock/invokemodel:*"
+        },
+        # data source bucket
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:GetObject",
+                "s3:ListBucket",
+                "s3:PutObject",
+                "s3:DeleteObject"
+            ],
+            "Resource": [
+                "arn:aws:s3:::${bucket}",
+                "arn:aws:s3:::${bucket}/*"
+            ]
+        },
+        # S3 vector index
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3vectors:*"
+            ],
+            "Resource": "arn:aws:s3vectors:${region}:${account}:bucket/${vector_store}/index/${vector_index}"
+        }
+    ]
+}))
+
+_ASSUME_ROLE_POLICY = json.dumps({
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Principal": {
+                "Service": "bedrock.amazonaws.com"
+            },
+            "Action": "sts:AssumeRole"
+        }
+    ]
+})
+
 def create_bedrock_execution_role(unique_id, region_name, bucket_name, vector_store_name,vector_index_name, account_id):            
         """
         Create Knowledge Base Execution IAM Role and its required policies.
@@ -115,111 +275,29 @@ def create_bedrock_execution_role(unique_id, region_name, bucket_name, vector_st
             IAM role
         """
 
-        foundation_model_policy_document = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "bedrock:InvokeModel",
-                    ],
-                    "Resource": [
-                        f"arn:aws:bedrock:{region_name}::foundation-model/amazon.titan-embed-text-v2:0",
-                        f"arn:aws:bedrock:{region_name}::foundation-model/anthropic.claude-3-sonnet-20240229-v1:0",
-                        f"arn:aws:bedrock:{region_name}::foundation-model/cohere.rerank-v3-5:0"             
-                    ]
-                }
-            ]
-        }
-
-        s3_policy_document = {
-                "Version": "2012-10-17",
-                "Statement": [
-                    {
-                        "Effect": "Allow",
-                        "Action": [
-                            "s3:GetObject",
-                            "s3:ListBucket",
-                            "s3:PutObject",
-                            "s3:DeleteObject"
-                        ],
-                        "Resource": [
-                            f"arn:aws:s3:::{bucket_name}",
-                            f"arn:aws:s3:::{bucket_name}/*"
-                        ]
-                    }
-                ]
-            }
-
-        cw_log_policy_document = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "logs:CreateLogStream",
-                        "logs:PutLogEvents",
-                        "logs:DescribeLogStreams"
-                    ],
-                    "Resource": "arn:aws:logs:*:*:log-group:/aws/bedrock/invokemodel:*"
-                }
-            ]
-        }
-
-        s3_vector_policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "s3vectors:*"
-                    ],
-                    "Resource": f"arn:aws:s3vectors:{region_name}:{account_id}:bucket/{vector_store_name}/index/{vector_index_name}"
-                }
-            ]
-        }
-
-        assume_role_policy_document = {
-        "Version": "2012-10-17",
-        
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Principal": {
-                    "Service": "bedrock.amazonaws.com"
-                },
-                "Action": "sts:AssumeRole"
-            }
-            ]
-        }
-
-        # combine all policies into one list from policy documents
-        policies = [
-            (f"foundation-model-policy_{unique_id}", foundation_model_policy_document, 'Policy for accessing foundation model'),
-            (f"cloudwatch-logs-policy_{unique_id}", cw_log_policy_document, 'Policy for writing logs to CloudWatch Logs'),
-            (f"s3-bucket_{unique_id}", s3_policy_document, 'Policy for s3 buckets'),
-            (f"s3vector_{unique_id}", s3_vector_policy, 'Policy for s3 Vector')]
-        
+        # single inline policy document with all required permissions
+        kb_policy_document = _KB_POLICY_TEMPLATE.substitute(
+            region=region_name,
+            bucket=bucket_name,
+            account=account_id,
+            vector_store=vector_store_name,
+            vector_index=vector_index_name
+        )
             
         # create bedrock execution role
         bedrock_kb_execution_role = iam_client.create_role(
             RoleName=f"kb_execution_role_s3_vector_{unique_id}",
-            AssumeRolePolicyDocument=json.dumps(assume_role_policy_document),
+            AssumeRolePolicyDocument=_ASSUME_ROLE_POLICY,
             Description='Amazon Bedrock Knowledge Base Execution Role',
             MaxSessionDuration=3600
         )
 
-        # create and attach the policies to the bedrock execution role
-        for policy_name, policy_document, description in policies:
-            policy = iam_client.create_policy(
-                PolicyName=policy_name,
-                PolicyDocument=json.dumps(policy_document),
-                Description=description,
-            )
-            iam_client.attach_role_policy(
-                RoleName=bedrock_kb_execution_role["Role"]["RoleName"],
-                PolicyArn=policy["Policy"]["Arn"]
-            )
+        # attach the combined permissions to the bedrock execution role in one call
+        iam_client.put_role_policy(
+            RoleName=bedrock_kb_execution_role["Role"]["RoleName"],
+            PolicyName=f"kb_inline_{unique_id}",
+            PolicyDocument=kb_policy_document
+        )
 
         return bedrock_kb_execution_role
     
@@ -292,45 +370,55 @@ def create_and_get_index_arn(s3vectors_client, vector_store_name, vector_index_n
         logger.info(f"❌ Failed to create or retrieve index: {error_code} - {error_message}")
         raise
 
-def create_knowledge_base(kb_name, bedrock, roleArn, vector_store_name, vector_index_name):
-    # Wait for IAM role propagation
-    logger.info("Waiting for IAM role propagation (60 seconds)...")
-    time.sleep(60)  # Wait for all policies and resources to be fully propagated
-
-    # Create the Knowledge Base
-    create_kb_response = bedrock.create_knowledge_base(
-        name=kb_name,
-        description='Amazon Bedrock Knowledge Bases with S3 Vector Store',
-        roleArn=roleArn,
-        knowledgeBaseConfiguration={
-            'type': 'VECTOR',
-            'vectorKnowledgeBaseConfiguration': {
-                # Specify the embedding model to use
-                'embeddingModelArn': f'arn:aws:bedrock:{region_name}::foundation-model/amazon.titan-embed-text-v2:0',
-                'embeddingModelConfiguration': {
-                    'bedrockEmbeddingModelConfiguration': {
-                        'dimensions': 1024,  # Should match the vector_dimension we defined earlier
-                        'embeddingDataType': 'FLOAT32'
-                    }
+# Error message fragments Bedrock returns while a new IAM role is still propagating
+IAM_PROPAGATION_ERRORS = ('not authorized', 'cannot assume role', 'unable to assume')
+
+def create_knowledge_base(kb_name, bedrock, roleArn, vector_store_name, vector_index_name, max_attempts=12):
+    # Create the Knowledge Base, retrying with backoff until the IAM role has propagated
+    for attempt in range(max_attempts):
+        try:
+            create_kb_response = bedrock.create_knowledge_base(
+                name=kb_name,
+                description='Amazon Bedrock Knowledge Bases with S3 Vector Store',
+                roleArn=roleArn,
+                knowledgeBaseConfiguration={
+                    'type': 'VECTOR',
+                    'vectorKnowledgeBaseConfiguration': {
+                        # Specify the embedding model to use
+                        'embeddingModelArn': f'arn:aws:bedrock:{region_name}::foundation-model/amazon.titan-embed-text-v2:0',
+                        'embeddingModelConfiguration': {
+                            'bedrockEmbeddingModelConfiguration': {
+                                'dimensions': 1024,  # Should match the vector_dimension we defined earlier
+                                'embeddingDataType': 'FLOAT32'
+                            }
+                        },
+                    },
                 },
-            },
-        },
-        storageConfiguration={
-            'type': 'S3_VECTORS',
-            's3VectorsConfiguration': {
-                'indexArn': f'arn:aws:s3vectors:{region_name}:{account_id}:bucket/{vector_store_name}/index/{vector_index_name}',
-            },
-        }
-    )
+                storageConfiguration={
+                    'type': 'S3_VECTORS',
+                    's3VectorsConfiguration': {
+                        'indexArn': f'arn:aws:s3vectors:{region_name}:{account_id}:bucket/{vector_store_name}/index/{vector_index_name}',
+                    },
+                }
+            )
+            break
+        except ClientError as e:
+            message = str(e).lower()
+            if attempt == max_attempts - 1 or not any(err in message for err in IAM_PROPAGATION_ERRORS):
+                raise
+            wait = min(2 ** attempt, 30)
+            logger.info(f"Waiting for IAM role propagation (retrying in {wait} seconds)...")
+            time.sleep(wait)
 
     knowledge_base_id = create_kb_response["knowledgeBase"]["knowledgeBaseId"]
     logger.info(f"Knowledge base ID: {knowledge_base_id}")
 
     logger.info(f"\nWaiting for knowledge base {knowledge_base_id} to finish creating...")
 
-    # Poll for KB creation status
+    # Poll for KB creation status, backing off from 2s up to 30s with jitter
     status = "CREATING"
     start_time = time.time()
+    delay = 2.0
 
     while status == "CREATING":
         # Get current status
@@ -344,8 +432,10 @@ def create_knowledge_base(kb_name, bedrock, roleArn, vector_store_name, vector_i
         logger.info(f"Current status: {status} (elapsed time: {elapsed_time}s)")
         
         if status == "CREATING":
-            logger.info("Still creating, checking again in 30 seconds...")
-            time.sleep(30)
+            wait = delay * random.uniform(0.9, 1.1)
+            logger.info(f"Still creating, checking again in {wait:.0f} seconds...")
+            time.sleep(wait)
+            delay = min(delay * 1.5, 30)
         else:
             break
 
@@ -384,33 +474,17 @@ def create_s3_data_source(bedrock, knowledge_base_id, bucket_name ):
     
 
 ### FUNCTIONS TO POPULATE S3 VECTOR KNOWLEDGE BASE WITH 10-K DOCUMENTS ### 
-def download_filing(url: str, filing: Dict, symbol: str) -> str:
-    """Download filing using sec-api render API"""
-
-    render_api = RenderApi(api_key=SEC_API_KEY)
-
-    try:
-        # Use render API to get the HTML content
-        html_content = render_api.get_filing(url)
-        
-        # Create filename and directory
-        year = filing['periodOfReport'][:4]
-        filename = f"{symbol}_{year}_{filing['periodOfReport']}_10K.html"
-        
-        local_dir = Path('./temp_10k') / year / symbol
-        local_dir.mkdir(parents=True, exist_ok=True)
-        local_file_path = local_dir / filename
-        
-        # Save to file
-        with open(local_file_path, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        
-        logger.info(f"Downloaded: {local_file_path}")
-        return str(local_file_path)
-        
-    except Exception as e:
-        logger.error(f"Error downloading filing {filing['accessionNo']}: {e}")
-        return None
+def query_filings(query: Dict) -> Dict:
+    """Run a sec-api filings query over the shared HTTP session"""
+    with sec_api_semaphore:
+        response = sec_http_session.post(
+            SEC_QUERY_API_URL,
+            params={'token': SEC_API_KEY},
+            json=query,
+            timeout=30
+        )
+    response.raise_for_status()
+    return response.json()
 
 def upload_to_s3(s3_bucket, local_file_path: str, symbol: str, year: str) -> bool:
     """
@@ -425,25 +499,45 @@ def upload_to_s3(s3_bucket, local_file_path: str, symbol: str, year: str) -> boo
         True if successful, False otherwise
     """
 
-    s3_client = boto3.client('s3')
+    try:
+        with open(local_file_path, 'rb') as f:
+            body = f.read()
+    except Exception as e:
+        logger.error(f"Error reading {local_file_path}: {e}")
+        return False
+
+    return upload_body_to_s3(s3_bucket, body, Path(local_file_path).name, symbol, year)
+
+def upload_body_to_s3(s3_bucket, body: bytes, filename: str, symbol: str, year: str) -> bool:
+    """
+    Upload in-memory HTML to S3 with organized structure
+    
+    Args:
+        body: HTML content as bytes
+        filename: Object file name
+        symbol: Company symbol
+        year: Filing year
+        
+    Returns:
+        True if successful, False otherwise
+    """
 
     try:
-        filename = Path(local_file_path).name
         s3_key = f"10k-reports/{year}/{symbol}/{filename}"
         
         logger.info(f"Uploading to S3: s3://{s3_bucket}/{s3_key}")
         
-        s3_client.upload_file(
-            local_file_path,
-            s3_bucket,
-            s3_key,
-            ExtraArgs={
-                'ContentType': 'text/html',
-                'Metadata': {
-                    'company-symbol': symbol,
-                    'filing-year': year,
-                    'document-type': '10K'
-                }
+        # 10-K HTML files are small enough to send in a single PUT,
+        # skipping the multipart transfer manager used by upload_file
+        s3_client.put_object(
+            Bucket=s3_bucket,
+            Key=s3_key,
+            Body=body,
+            ContentType='text/html',
+            Metadata={
+                'company-symbol': symbol,
+                'filing-year': year,
+                'document-type': '10K'
             }
         )
         
@@ -451,9 +545,73 @@ def upload_to_s3(s3_bucket, local_file_path: str, symbol: str, year: str) -> boo
         return True
         
     except Exception as e:
-        logger.error(f"Error uploading {local_file_path} to S3: {e}")
+        logger.error(f"Error uploading {filename} to S3: {e}")
         return False
 
+def stream_filing_to_s3(s3_bucket, url: str, filing: Dict, symbol: str) -> Tuple[bool, bool, Optional[str]]:
+    """
+    Stream a filing from the sec-api filing mirror straight into S3
+    
+    Args:
+        s3_bucket: S3 bucket name
+        url: Filing URL
+        filing: Filing metadata from the query API
+        symbol: Company symbol
+        
+    Returns:
+        (downloaded, uploaded, error) tuple
+    """
+    year = filing['periodOfReport'][:4]
+    filename = f"{symbol}_{year}_{filing['periodOfReport']}_10K.html"
+    s3_key = f"10k-reports/{year}/{symbol}/{filename}"
+
+    # Same URL rewrite sec-api's RenderApi.get_filing applies
+    path = re.sub(r"ix\?doc=/", "", url)
+    path = re.sub(r"https://www.sec.gov/Archives/edgar/data", "", path)
+
+    # Hold the semaphore until the body has been read, so it caps concurrent
+    # mirror downloads rather than just request starts
+    with sec_api_semaphore:
+        response = None
+        try:
+            response = sec_http_session.get(
+                f"{SEC_FILING_MIRROR_URL}{path}",
+                params={'token': SEC_API_KEY},
+                stream=True,
+                timeout=30
+            )
+            response.raise_for_status()
+        except Exception as e:
+            if response is not None:
+                response.close()
+            logger.error(f"Error downloading filing {filing['accessionNo']}: {e}")
+            return False, False, f"Failed to download filing {filing['accessionNo']}"
+
+        try:
+            with response:
+                # Let urllib3 undo any gzip/deflate transfer encoding while streaming
+                response.raw.decode_content = True
+                logger.info(f"Streaming to S3: s3://{s3_bucket}/{s3_key}")
+                s3_client.upload_fileobj(
+                    response.raw,
+                    s3_bucket,
+                    s3_key,
+                    ExtraArgs={
+                        'ContentType': 'text/html',
+                        'Metadata': {
+                            'company-symbol': symbol,
+                            'filing-year': year,
+                            'document-type': '10K'
+                        }
+                    },
+                    Config=STREAM_TRANSFER_CONFIG
+                )
+            logger.info(f"Successfully uploaded: {s3_key}")
+            return True, True, None
+        except Exception as e:
+            logger.error(f"Error uploading {filename} to S3: {e}")
+            return True, False, f"Failed to upload {filename}"
+
 def cleanup_local_file(file_path: str):
     """Remove local file after successful upload"""
     try:
@@ -462,13 +620,18 @@ def cleanup_local_file(file_path: str):
     except Exception as e:
         logger.warning(f"Could not clean up {file_path}: {e}")
 
-def process_company(bucket_name, symbol: str, years_back: int = 5) -> Dict:
+# Filing downloads/uploads from all process_company calls share this pool; each
+# stream holds an SEC API permit, so it is sized to the SEC API concurrency cap
+_FILING_POOL = ThreadPoolExecutor(max_workers=SEC_API_MAX_CONCURRENCY)
+
+def process_company(bucket_name, symbol: str, years_back: int = 5, filings: List[Dict] = None) -> Dict:
     """
     Process all 10K filings for a single company
     
     Args:
         symbol: Company stock symbol
         years_back: Number of years to look back
+        filings: Pre-fetched filings for the company; queried from SEC API if None
         
     Returns:
         Dictionary with processing results
@@ -484,7 +647,8 @@ def process_company(bucket_name, symbol: str, years_back: int = 5) -> Dict:
     }
     
     # Get 10K filings
-    filings = get_filings(symbol)
+    if filings is None:
+        filings = get_filings(symbol, years_back)
     
     results['total_filings'] = len(filings)
     
@@ -496,33 +660,30 @@ def process_company(bucket_name, symbol: str, years_back: int = 5) -> Dict:
         results['errors'].append(error_msg)
         return results
     
-    # Process each filing
-    for filing in filings:
-        logger.info(f"Downloding filings")
+    def _handle_filing(filing):
+        """Download and upload one filing, returning (downloaded, uploaded, error)"""
         try:
-            print(f"Filing type: {type(filing)}, Filing value: {filing}")
+            logger.debug("Filing value: %s", filing)
             url = filing['linkToFilingDetails']
-            # Download filing
+            # Download filing and upload it to S3 as it streams in
             logger.info(f"Downloading filing {url}")
-            local_file_path = download_filing(url, filing, symbol)
-            if local_file_path:
-                results['downloaded'] += 1
-                
-                # Upload to S3
-                year = filing['periodOfReport'][:4]
-                if upload_to_s3(bucket_name, local_file_path, symbol, year):
-                    results['uploaded'] += 1
-                    # Clean up local file after successful upload
-                    #cleanup_local_file(local_file_path)
-                else:
-                    results['errors'].append(f"Failed to upload {local_file_path}")
-            else:
-                results['errors'].append(f"Failed to download filing {filing['accessionNo']}")
+            return stream_filing_to_s3(bucket_name, url, filing, symbol)
                 
         except Exception as e:
             error_msg = f"Error processing filing {filing['accessionNo']}: {e}"
             logger.error(error_msg)
-            results['errors'].append(error_msg)
+            return False, False, error_msg
+
+    # Process each filing on the shared filing pool, so at most
+    # SEC_API_MAX_CONCURRENCY filings stream at once however many companies
+    # are processed
+    outcomes = list(_FILING_POOL.map(_handle_filing, filings))
+
+    for downloaded, uploaded, error in outcomes:
+        results['downloaded'] += downloaded
+        results['uploaded'] += uploaded
+        if error:
+            results['errors'].append(error)
     
     return results
 
@@ -539,9 +700,6 @@ def get_filings(symbol: str, years_back: int = 5) -> Dict:
     """
     logger.info(f"Processing company: {symbol}")
     
-    # Initialize SEC API client (get free API key from sec-api.io)
-    query_api = QueryApi(api_key=SEC_API_KEY)
-    
     results = {
         'symbol': symbol,
         'total_filings': 0,
@@ -552,24 +710,79 @@ def get_filings(symbol: str, years_back: int = 5) -> Dict:
 
     query = {
         "query": { "query_string": { 
-            "query": f"formType:\"10-K\" AND ticker:{symbol}", # only 10-Ks
+            "query": TEN_K_QUERY.format(tickers=symbol), # only 10-Ks
         }},
         "from": "0", # start returning matches from position null, i.e. the first matching filing 
         "size": f"{years_back}"  # return last 
     }
 
-    response = query_api.get_filings(query)
-    print(json.dumps(response["filings"][0], indent=2))
+    # Query the SEC API (get free API key from sec-api.io)
+    response = query_filings(query)
+    if response["filings"] and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("First filing: %s", json.dumps(response["filings"][0], indent=2))
     results['total_filings'] = len(response["filings"])
     return response["filings"]
 
-def process_companies(bucket_name, symbols: List[str], api_key: str,  years_back: int = 5) -> Dict:
+def get_filings_bulk(symbols: List[str], years_back: int = 5) -> Dict[str, List[Dict]]:
+    """
+    Fetch 10K filings for many companies with one paged query per chunk of symbols
+    
+    Args:
+        symbols: List of company stock symbols
+        years_back: Number of filings to keep per company
+        
+    Returns:
+        Dictionary mapping each symbol to its most recent filings
+    """
+    filings_by_symbol = {symbol: [] for symbol in symbols}
+    lookup = {symbol.upper(): symbol for symbol in symbols}
+
+    for start in range(0, len(symbols), SEC_QUERY_CHUNK_SIZE):
+        chunk = symbols[start:start + SEC_QUERY_CHUNK_SIZE]
+        wanted = len(chunk) * years_back
+        offset = 0
+        exhausted = False
+
+        while offset < wanted:
+            query = {
+                "query": { "query_string": {
+                    "query": TEN_K_QUERY.format(tickers=f"({' OR '.join(chunk)})"),
+                }},
+                "from": f"{offset}",
+                "size": f"{SEC_QUERY_PAGE_SIZE}",
+                "sort": [{ "filedAt": { "order": "desc" }}]
+            }
+            response = query_filings(query)
+
+            page = response.get("filings", [])
+            for filing in page:
+                symbol = lookup.get(str(filing.get('ticker', '')).upper())
+                if symbol and len(filings_by_symbol[symbol]) < years_back:
+                    filings_by_symbol[symbol].append(filing)
+
+            if len(page) < SEC_QUERY_PAGE_SIZE:
+                exhausted = True
+                break
+            offset += SEC_QUERY_PAGE_SIZE
+
+        # Tickers whose filings rank below the others' older ones can still be
+        # short when paging stops early; query those individually
+        if not exhausted:
+            for symbol in chunk:
+                if len(filings_by_symbol[symbol]) < years_back:
+                    filings_by_symbol[symbol] = get_filings(symbol, years_back)
+
+    return filings_by_symbol
+
+def process_companies(bucket_name, symbols: List[str], api_key: str,  years_back: int = 5,
+                      max_workers: int = MAX_COMPANY_WORKERS) -> Dict:
     """
-    Process multiple companies
+    Process multiple companies concurrently
     
     Args:
         symbols: List of company symbols
         years_back: Number of years to look back
+        max_workers: Number of companies processed in parallel
         
     Returns:
         Dictionary with overall results
@@ -591,53 +804,71 @@ def process_companies(bucket_name, symbols: List[str], api_key: str,  years_back
         'end_time': None
     }
     
-    for i, symbol in enumerate(symbols, 1):
-        try:
-            logger.info(f"\n[{i}/{len(symbols)}] Processing {symbol}...")
-            results = process_company(bucket_name, symbol, years_back)
-            overall_results['company_results'][symbol] = results
-            overall_results['companies_processed'] += 1
-            overall_results['total_filings_found'] += results['total_filings']
-            overall_results['total_downloaded'] += results['downloaded']
-            overall_results['total_uploaded'] += results['uploaded']
-            
-            # Progress update
-            success_rate = f"{results['uploaded']}/{results['total_filings']}" if results['total_filings'] > 0 else "0/0"
-            logger.info(f"✅ {symbol}: {success_rate} reports uploaded to S3")
-            
-            if results['errors']:
-                logger.info(f"⚠️  {symbol}: {len(results['errors'])} errors occurred")
-            
-            # Rate limiting between companies
-            time.sleep(1)
-            
-        except Exception as e:
-            error_msg = f"Error processing company {symbol}: {e}"
-            logger.error(error_msg)
-            logger.info(f"❌ {symbol}: Processing failed - {e}")
-            overall_results['company_results'][symbol] = {
-                'symbol': symbol,
-                'total_filings': 0,
-                'downloaded': 0,
-                'uploaded': 0,
-                'errors': [error_msg]
-            }
+    # Fetch filings for all companies up front; fall back to per-company queries on failure
+    try:
+        filings_by_symbol = get_filings_bulk(symbols, years_back)
+    except Exception as e:
+        logger.warning(f"Bulk filings query failed, querying companies individually: {e}")
+        filings_by_symbol = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(process_company, bucket_name, symbol, years_back,
+                            filings_by_symbol.get(symbol)): symbol
+            for symbol in symbols
+        }
+
+        for i, future in enumerate(as_completed(futures), 1):
+            symbol = futures[future]
+            try:
+                results = future.result()
+                logger.info(f"\n[{i}/{len(symbols)}] Processed {symbol}")
+                overall_results['company_results'][symbol] = results
+                overall_results['companies_processed'] += 1
+                overall_results['total_filings_found'] += results['total_filings']
+                overall_results['total_downloaded'] += results['downloaded']
+                overall_results['total_uploaded'] += results['uploaded']
+                
+                # Progress update
+                success_rate = f"{results['uploaded']}/{results['total_filings']}" if results['total_filings'] > 0 else "0/0"
+                logger.info(f"✅ {symbol}: {success_rate} reports uploaded to S3")
+                
+                if results['errors']:
+                    logger.info(f"⚠️  {symbol}: {len(results['errors'])} errors occurred")
+                
+            except Exception as e:
+                error_msg = f"Error processing company {symbol}: {e}"
+                logger.error(error_msg)
+                logger.info(f"❌ {symbol}: Processing failed - {e}")
+                overall_results['company_results'][symbol] = {
+                    'symbol': symbol,
+                    'total_filings': 0,
+                    'downloaded': 0,
+                    'uploaded': 0,
+                    'errors': [error_msg]
+                }
     
     overall_results['end_time'] = datetime.now().isoformat()
     
-    # Save results to file
+    # Save results to file as compact JSON, streamed chunk by chunk
     with open('download_results.json', 'w') as f:
-        json.dump(overall_results, f, indent=2)
+        for chunk in json.JSONEncoder(separators=(',', ':')).iterencode(overall_results):
+            f.write(chunk)
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Download results: %s", json.dumps(overall_results, indent=2))
     
     return overall_results
 
-def upload_companies(bucket_name: str, preloaded_path: str = "./preloaded_10k") -> Dict:
+def upload_companies(bucket_name: str, preloaded_path: str = "./preloaded_10k",
+                     max_workers: int = MAX_UPLOAD_WORKERS) -> Dict:
     """
     Upload preloaded 10K documents to S3
     
     Args:
         bucket_name: S3 bucket name
         preloaded_path: Path to preloaded 10k documents
+        max_workers: Number of concurrent uploads
         
     Returns:
         Dictionary with upload results
@@ -654,28 +885,23 @@ def upload_companies(bucket_name: str, preloaded_path: str = "./preloaded_10k")
     
     preloaded_dir = Path(preloaded_path)
     
-    for year_dir in preloaded_dir.iterdir():
-        if not year_dir.is_dir():
-            continue
-            
-        year = year_dir.name
+    # Files are laid out as <year>/<symbol>/<file>.html
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for file_path in preloaded_dir.glob("*/*/*.html"):
+            year, symbol = file_path.parts[-3], file_path.parts[-2]
+            results['company_results'].setdefault(symbol, {'uploaded': 0})
+            futures[executor.submit(upload_to_s3, bucket_name, str(file_path), symbol, year)] = symbol
         
-        for company_dir in year_dir.iterdir():
-            if not company_dir.is_dir():
-                continue
-                
-            symbol = company_dir.name
-            
-            if symbol not in results['company_results']:
-                results['company_results'][symbol] = {'uploaded': 0}
-            
-            for file_path in company_dir.glob("*.html"):
-                if upload_to_s3(bucket_name, str(file_path), symbol, year):
-                    results['total_uploaded'] += 1
-                    results['company_results'][symbol]['uploaded'] += 1
-                    
-            if symbol not in [k for k in results['company_results'].keys() if results['company_results'][k]['uploaded'] == 0]:
-                results['companies_processed'] += 1
+        for future in as_completed(futures):
+            if future.result():
+                symbol = futures[future]
+                results['total_uploaded'] += 1
+                results['company_results'][symbol]['uploaded'] += 1
+    
+    results['companies_processed'] = sum(
+        1 for company in results['company_results'].values() if company['uploaded'] > 0
+    )
     
     results['end_time'] = datetime.now().isoformat()
     
@@ -713,27 +939,33 @@ def process_traces(langfuse, traces):
     multi_turn_samples = []
     trace_sample_mapping = []
     test_cases = load_test_cases()
+    # Exact lookup for inputs that are just the test query; substring matching on miss
+    test_case_index = build_test_case_index(test_cases)
+    matcher = build_matcher(test_cases)
     
     for trace in traces:
         components = extract_span_components(langfuse, trace)
         
         if components["user_inputs"]:
-            print(f"User inputs: {components['user_inputs']}")
-            print(f"Agent responses: {components['agent_responses']}")
+            logger.debug("User inputs: %s", components['user_inputs'])
+            logger.debug("Agent responses: %s", components['agent_responses'])
 
             # Get the first user input for matching
             first_user_input = components["user_inputs"][0] if components["user_inputs"] else ""
             
+            # Interleave user and assistant turns
             messages = []
-            for i in range(max(len(components["user_inputs"]), len(components["agent_responses"]))):
-                if i < len(components["user_inputs"]):
-                    messages.append({"role": "user", "content": components["user_inputs"][i]})
-                if i < len(components["agent_responses"]):
-                    messages.append({"role": "assistant", "content": components["agent_responses"][i]})
+            for user_input, agent_response in zip_longest(components["user_inputs"], components["agent_responses"]):
+                if user_input is not None:
+                    messages.append({"role": "user", "content": user_input})
+                if agent_response is not None:
+                    messages.append({"role": "assistant", "content": agent_response})
             
-            print("Trying to append Multi turn samples...")
+            logger.debug("Appending multi turn sample for trace %s", trace.id)
             # Match with expected answer using the first user input
-            expected_answer = match_trace_to_test_case(first_user_input, test_cases)
+            expected_answer = test_case_index.get(normalize_query(first_user_input))
+            if expected_answer is None:
+                expected_answer = match_trace_to_test_case(first_user_input, matcher)
             multi_turn_samples.append(
                 MultiTurnSample(
                     user_input=messages,
@@ -752,6 +984,24 @@ def process_traces(langfuse, traces):
     }
 
 
+# Page size used when listing a trace's observations
+OBSERVATIONS_PAGE_SIZE = 100
+
+def _get_trace_observations(langfuse, trace_id):
+    """Fetch all observations of a Langfuse trace, one page request at a time"""
+    observations = []
+    page = 1
+    while True:
+        response = langfuse.api.observations.get_many(
+            trace_id=trace_id,
+            page=page,
+            limit=OBSERVATIONS_PAGE_SIZE
+        )
+        observations.extend(response.data)
+        if page >= response.meta.total_pages:
+            return observations
+        page += 1
+
 def extract_span_components(langfuse, trace):
     """Extract user queries, agent responses, retrieved contexts 
     and tool usage from a Langfuse trace"""
@@ -778,26 +1028,25 @@ def extract_span_components(langfuse, trace):
 
     # Try to get contexts from observations and tool usage details
     try:
-        for obsID in trace.observations:
-            print (f"Getting Observation {obsID}")
-            observations = langfuse.api.observations.get(obsID)
-
-            for obs in observations:
-                # Extract tool usage information
-                if hasattr(obs, 'name') and obs.name:
-                    tool_name = str(obs.name)
-                    tool_input = obs.input if hasattr(obs, 'input') and obs.input else None
-                    tool_output = obs.output if hasattr(obs, 'output') and obs.output else None
-                    tool_usages.append({
-                        "name": tool_name,
-                        "input": tool_input,
-                        "output": tool_output
-                    })
-                    # Specifically capture retrieved contexts
-                    if 'retrieve' in tool_name.lower() and tool_output:
-                        retrieved_contexts.append(str(tool_output))
+        logger.debug("Getting observations for trace %s", trace.id)
+        observations = _get_trace_observations(langfuse, trace.id)
+
+        for obs in observations:
+            # Extract tool usage information
+            if hasattr(obs, 'name') and obs.name:
+                tool_name = str(obs.name)
+                tool_input = obs.input if hasattr(obs, 'input') and obs.input else None
+                tool_output = obs.output if hasattr(obs, 'output') and obs.output else None
+                tool_usages.append({
+                    "name": tool_name,
+                    "input": tool_input,
+                    "output": tool_output
+                })
+                # Specifically capture retrieved contexts
+                if 'retrieve' in tool_name.lower() and tool_output:
+                    retrieved_contexts.append(str(tool_output))
     except Exception as e:
-        print(f"Error fetching observations: {e}")
+        logger.warning("Error fetching observations: %s", e)
 
     # Extract tool names from metadata if available
     if hasattr(trace, 'metadata') and trace.metadata:
@@ -813,59 +1062,282 @@ def extract_span_components(langfuse, trace):
         "available_tools": available_tools if 'available_tools' in locals() else []
     }
 
-def save_results_to_csv(rag_df=None, conv_df=None, output_dir="evaluation_results"):
-    """Save evaluation results to CSV files"""
+# Background pool for writing result files off the caller's critical path
+_IO_POOL = ThreadPoolExecutor(max_workers=2)
+
+def save_results_to_csv(rag_df=None, conv_df=None, output_dir="evaluation_results", file_format="parquet", wait=False):
+    """
+    Save evaluation results to files
+    
+    Args:
+        rag_df: RAG evaluation results
+        conv_df: Conversation evaluation results
+        output_dir: Directory to write the files to
+        file_format: "parquet" (snappy-compressed, keeps dtypes) or "csv"
+        wait: Block until the files are written instead of writing in the background
+        
+    Returns:
+        Dictionary with the paths of the files and, when wait is False, the
+        futures of the pending writes (see flush_results)
+    """
+    if file_format not in ("parquet", "csv"):
+        raise ValueError(f"Unsupported file format: {file_format}")
+
     os.makedirs(output_dir, exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
+    def _write(df, file_path):
+        if file_format == "parquet":
+            df.to_parquet(file_path, index=False, compression="snappy", engine="pyarrow")
+        else:
+            df.to_csv(file_path, index=False)
+    
+    def _submit(df, file_path):
+        def _log_error(future):
+            # Report failures even if the caller never calls flush_results
+            error = future.exception()
+            if error is not None:
+                logger.error(f"Error writing {file_path}: {error}")
+        
+        future = _IO_POOL.submit(_write, df, file_path)
+        future.add_done_callback(_log_error)
+        return future
+    
     results = {}
     
     if rag_df is not None and not rag_df.empty:
-        rag_file = os.path.join(output_dir, f"rag_evaluation_{timestamp}.csv")
-        rag_df.to_csv(rag_file, index=False)
-        print(f"RAG evaluation results saved to {rag_file}")
+        rag_file = os.path.join(output_dir, f"rag_evaluation_{timestamp}.{file_format}")
+        results["rag_write_future"] = _submit(rag_df, rag_file)
+        print(f"Saving RAG evaluation results to {rag_file}")
         results["rag_file"] = rag_file
     
     if conv_df is not None and not conv_df.empty:
-        conv_file = os.path.join(output_dir, f"conversation_evaluation_{timestamp}.csv")
-        conv_df.to_csv(conv_file, index=False)
-        print(f"Conversation evaluation results saved to {conv_file}")
+        conv_file = os.path.join(output_dir, f"conversation_evaluation_{timestamp}.{file_format}")
+        results["conv_write_future"] = _submit(conv_df, conv_file)
+        print(f"Saving conversation evaluation results to {conv_file}")
         results["conv_file"] = conv_file
     
+    if wait:
+        flush_results(results)
+    
+    return results
+
+def flush_results(results):
+    """Wait for background writes started by save_results_to_csv and re-raise any errors"""
+    for key in ("rag_write_future", "conv_write_future"):
+        future = results.pop(key, None)
+        if future is not None:
+            future.result()
     return results
 
 ###Run Test Cases with Rate Limiting
-def run_test_cases_sync(agent, test_cases, delay=4):
-    import time
+_BANNER = "=" * 50
+
+# Error message fragments for agent failures worth retrying (throttling, timeouts)
+TRANSIENT_AGENT_ERRORS = ('throttl', 'too many requests', 'rate exceeded', 'timed out', 'timeout', 'service unavailable')
+
+def _is_transient_error(e):
+    """Return True if an agent error looks like throttling or a transient network failure"""
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    message = f"{type(e).__name__} {e}".lower()
+    return any(err in message for err in TRANSIENT_AGENT_ERRORS)
+
+def _retry_after(e):
+    """Return the Retry-After delay in seconds carried by an error, if any"""
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    else:
+        # requests / httpx style errors
+        headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def run_test_cases_sync(agent, test_cases, delay=4, rate_per_minute=None, max_retries=3, backoff_base=2, backoff_cap=30):
+    """
+    Run test cases against the agent, starting at most one request per period
+    
+    Args:
+        agent: Callable agent invoked with each test query
+        test_cases: List of test cases with query and expected_answer
+        delay: Minimum seconds between the start of consecutive requests
+        rate_per_minute: Requests per minute; overrides delay when set
+        max_retries: Retries for throttled or timed out calls before recording an error
+        backoff_base: Initial back-off in seconds, doubled on each retry
+        backoff_cap: Maximum back-off in seconds between retries
+        
+    Returns:
+        List of result dictionaries
+    """
+    period = 60.0 / rate_per_minute if rate_per_minute else delay
+    n = len(test_cases)
     results = []
     
+    # Only wait out whatever is left of the period after the previous request
+    next_slot = time.monotonic()
+    
     for i, test_case in enumerate(test_cases):
-        print(f"\n{'='*50}")
-        print(f"Test Case {i+1}/{len(test_cases)}: {test_case['query']}")
-        print(f"{'='*50}")
+        logger.info(f"\n{_BANNER}\nTest Case {i+1}/{n}: {test_case['query']}\n{_BANNER}")
         
-        try:
-            response = agent(test_case["query"])
-            print(f"Response: {response}")
-            results.append({"query": test_case["query"], "response": response, "expected": test_case["expected_answer"]})
-            
-            if i < len(test_cases) - 1:
-                time.sleep(delay)
-                
-        except Exception as e:
-            print(f"Error: {e}")
-            results.append({"query": test_case["query"], "error": str(e)})
+        sleep_for = next_slot - time.monotonic()
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+        next_slot = time.monotonic() + period
+        
+        # Retry transient failures with jittered exponential back-off; record
+        # an error only once retries are exhausted or the failure is permanent
+        for attempt in range(max_retries + 1):
+            try:
+                response = agent(test_case["query"])
+                logger.info(f"Response: {response}")
+                results.append({"query": test_case["query"], "response": response, "expected": test_case["expected_answer"]})
+                break
+            except Exception as e:
+                if attempt == max_retries or not _is_transient_error(e):
+                    logger.error(f"Error: {e}")
+                    results.append({"query": test_case["query"], "error": str(e)})
+                    break
+                wait = _retry_after(e)
+                if wait is None:
+                    wait = min(backoff_base * 2 ** attempt, backoff_cap) + random.random()
+                # Never retry sooner than the configured request rate allows
+                wait = max(wait, next_slot - time.monotonic())
+                logger.info(f"Transient error: {e} (retrying in {wait:.1f} seconds)...")
+                time.sleep(wait)
+                # A retry is a new request, so it restarts the pacing period
+                next_slot = time.monotonic() + period
     
     return results
 
-def load_test_cases():
-    with open("test_cases.json", "r") as f:
-        data = json.load(f)
-        return data["questions"]
+async def run_test_cases_async(agent, test_cases, concurrency=5, rate_per_minute=60):
+    """
+    Run test cases against the agent concurrently, bounded by a concurrency
+    limit and a requests-per-minute rate
+    
+    Args:
+        agent: Sync or async callable invoked with each test query; it must be
+            safe to call concurrently (e.g. a fresh agent per call)
+        test_cases: List of test cases with query and expected_answer
+        concurrency: Maximum number of in-flight agent calls
+        rate_per_minute: Maximum number of agent calls started per minute
+        
+    Returns:
+        List of result dictionaries, in test case order
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    slot_lock = asyncio.Lock()
+    period = 60.0 / rate_per_minute
+    n = len(test_cases)
+    loop = asyncio.get_running_loop()
+    next_slot = loop.time()
+    is_async_agent = inspect.iscoroutinefunction(agent) or inspect.iscoroutinefunction(getattr(agent, "__call__", None))
+
+    async def _wait_for_slot():
+        nonlocal next_slot
+        async with slot_lock:
+            now = loop.time()
+            wait = next_slot - now
+            next_slot = max(next_slot, now) + period
+        if wait > 0:
+            await asyncio.sleep(wait)
 
-def match_trace_to_test_case(user_input, test_cases):
-    """Match trace user input to test case"""
-    for test_case in test_cases:
-        if test_case["query"].lower() in user_input.lower():
-            return test_case["expected_answer"]
+    async def _run_one(i, test_case):
+        async with semaphore:
+            await _wait_for_slot()
+            logger.info(f"Test Case {i+1}/{n}: {test_case['query']}")
+            try:
+                if is_async_agent:
+                    response = await agent(test_case["query"])
+                else:
+                    response = await asyncio.to_thread(agent, test_case["query"])
+                logger.info(f"Response {i+1}: {response}")
+                return {"query": test_case["query"], "response": response, "expected": test_case["expected_answer"]}
+            except Exception as e:
+                logger.error(f"Error {i+1}: {e}")
+                return {"query": test_case["query"], "error": str(e)}
+
+    return await asyncio.gather(*(_run_one(i, test_case) for i, test_case in enumerate(test_cases)))
+
+def load_test_cases(path="test_cases.json"):
+    """Load test cases, re-parsing the file only when its modification time changes"""
+    # Return a copy so callers can mutate the result without touching the cache
+    return copy.deepcopy(_load_test_cases(path, os.stat(path).st_mtime_ns))
+
+@functools.lru_cache(maxsize=4)
+def _load_test_cases(path, mtime_ns):
+    if orjson is None:
+        with open(path, "r") as f:
+            data = json.load(f)
+            return data["questions"]
+
+    # Parse the memory-mapped file bytes directly, without decoding to str first
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as view:
+        data = orjson.loads(view)
+    return data["questions"]
+
+def prepare_test_cases(test_cases):
+    """Lowercase test case queries once for repeated matching"""
+    return [(test_case["query"].lower(), test_case["expected_answer"]) for test_case in test_cases]
+
+def build_matcher(test_cases):
+    """
+    Build a matcher for match_trace_to_test_case
+    
+    Returns an Aho-Corasick automaton over the lowercased queries when
+    pyahocorasick is installed, otherwise the prepared test case list
+    """
+    prepared_test_cases = prepare_test_cases(test_cases)
+    if ahocorasick is None:
+        return prepared_test_cases
+
+    automaton = ahocorasick.Automaton()
+    for index, (query_lc, expected_answer) in enumerate(prepared_test_cases):
+        # Keep the first test case for duplicate queries, as the linear scan does
+        if query_lc and not automaton.exists(query_lc):
+            automaton.add_word(query_lc, (index, expected_answer))
+    if len(automaton) == 0:
+        return prepared_test_cases
+    automaton.make_automaton()
+    return automaton
+
+def match_trace_to_test_case(user_input, matcher):
+    """
+    Match trace user input to a test case using a matcher from build_matcher
+
+    Raw test case dicts are also accepted and prepared on each call
+    """
+    if matcher and isinstance(matcher, list) and isinstance(matcher[0], dict):
+        matcher = prepare_test_cases(matcher)
+
+    user_input_lc = user_input.lower()
+
+    if ahocorasick is not None and isinstance(matcher, ahocorasick.Automaton):
+        # Single pass over the input; earliest test case wins like the linear scan
+        matches = [value for _end, value in matcher.iter(user_input_lc)]
+        return min(matches)[1] if matches else None
+
+    # Queries longer than the input cannot match, so skip the substring search
+    input_len = len(user_input_lc)
+    for query_lc, expected_answer in matcher:
+        if len(query_lc) <= input_len and query_lc in user_input_lc:
+            return expected_answer
     return None
+
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+def normalize_query(text):
+    """Lowercase, strip punctuation and collapse whitespace for exact query lookups"""
+    return " ".join(text.lower().translate(_PUNCTUATION_TABLE).split())
+
+def build_test_case_index(test_cases):
+    """Map normalized test case queries to their expected answers"""
+    index = {}
+    for test_case in test_cases:
+        index.setdefault(normalize_query(test_case["query"]), test_case["expected_answer"])
+    return index